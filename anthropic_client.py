@@ -0,0 +1,36 @@
+from functools import lru_cache
+from typing import Dict, List
+from anthropic import Anthropic
+import httpx
+import os
+
+
+def max_concurrency() -> int:
+    """
+    Per-process cap on concurrent upstream calls, shared by the Claude and OpenWeather pools
+    """
+    return int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", "128"))
+
+
+@lru_cache(maxsize=1)
+def get_anthropic_client(api_key: str) -> Anthropic:
+    """
+    Process-wide Anthropic client so both agents share one keep-alive connection pool.
+    The pool size bounds concurrent Claude calls per process; further callers wait
+    (cooperatively under gevent) for a free connection instead of blocking a thread.
+    """
+    limit = max_concurrency()
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_keepalive_connections=limit // 2, max_connections=limit),
+        timeout=httpx.Timeout(30.0, connect=3.0, pool=30.0)
+    )
+    return Anthropic(api_key=api_key, http_client=http_client)
+
+
+def cached_system_prompt(text: str) -> List[Dict]:
+    """
+    System block marked for Anthropic prompt caching; keep the text identical across calls.
+    Haiku only caches prefixes of at least 2048 tokens, so for today's short prompts the
+    marker is a no-op; it starts paying off only if a prompt grows past that.
+    """
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
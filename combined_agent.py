@@ -1,23 +1,53 @@
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from weather_agent import WeatherAgent  # Import your WeatherAgent class
 from language_agent import LanguageAgent  # Import your LanguageAgent class
+import hmac
 import os
+import orjson
 from datetime import datetime, timezone
 
 load_dotenv()
+
+
+class ORJSONProvider(JSONProvider):
+    """
+    Serialize jsonify() responses with orjson instead of the stdlib json module
+    """
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs) -> Response:
+        # Hand orjson's bytes straight to the response instead of decoding and re-encoding
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC),
+            mimetype="application/json"
+        )
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
 
 
 # Initialize both agents
-weather_agent = WeatherAgent()
-language_agent = LanguageAgent()
+weather_agent = WeatherAgent(
+    anthropic_api_key=os.getenv("ANTHROPIC_API_KEY"),
+    weather_api_key=os.getenv("WEATHER_API_KEY")
+)
+language_agent = LanguageAgent(api_key=os.getenv("ANTHROPIC_API_KEY"))
 
 # Define API key
 API_KEY="neha-2024"
+# Admin routes need their own secret (API_KEY ships in the web client); unset disables them
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
 # Weather agent routes
 @app.route("/weather/query", methods=["POST"])
 def weather_query():
@@ -26,9 +56,14 @@ def weather_query():
         return jsonify({"error": "Invalid API key"}), 401
 
     data = request.get_json()
-    if not data or "query" not in data:
+    if not isinstance(data, dict) or "query" not in data:
         return jsonify({"error": "Missing query parameter"}), 400
 
+    # Opt-in Server-Sent Events: weather report text is streamed as it is generated
+    if data.get("stream"):
+        return Response(stream_weather_events(data["query"]), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache"})
+
     try:
         response = weather_agent.process_query(data["query"])
         return jsonify(response)
@@ -40,6 +75,19 @@ def weather_query():
             }
         }), 500
 
+def stream_weather_events(query):
+    try:
+        for event, payload in weather_agent.stream_query(query):
+            yield f"event: {event}\ndata: {orjson.dumps(payload).decode()}\n\n"
+    except Exception as e:
+        error = {
+            "error": str(e),
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat()
+            }
+        }
+        yield f"event: error\ndata: {orjson.dumps(error).decode()}\n\n"
+
 # Language agent routes
 @app.route("/language/query", methods=["POST"])
 def language_query():
@@ -58,5 +106,33 @@ def language_query():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Admin routes
+@app.route("/admin/cache/invalidate", methods=["POST"])
+def invalidate_cache():
+    if not ADMIN_API_KEY:
+        return jsonify({"error": "Not found"}), 404
+
+    api_key = request.headers.get("X-API-Key")
+    if not api_key or not hmac.compare_digest(api_key, ADMIN_API_KEY):
+        return jsonify({"error": "Invalid API key"}), 401
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+
+    city = data.get("city")
+    if city is not None and not isinstance(city, str):
+        return jsonify({"error": "city must be a string or null"}), 400
+
+    # The weather cache is per worker process, so this only clears the worker that
+    # handles the request; other workers expire their entries within the 5 minute TTL
+    removed = weather_agent.invalidate_weather_cache(city)
+    return jsonify({
+        "invalidated": removed,
+        "city": city,
+        "scope": "worker",
+        "worker_pid": os.getpid()
+    })
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,95 @@
+from functools import lru_cache
+from typing import Iterable, Optional
+import os
+import re
+
+try:
+    import marisa_trie
+except ImportError:
+    marisa_trie = None
+
+_TOKEN_RE = re.compile(r"[\w'-]+")
+
+# Bare single-word city names are only trusted right after one of these
+_LOCATION_PREPOSITIONS = frozenset(['in', 'at', 'for'])
+
+# Single words that are also place names somewhere but almost never mean one in a query
+_COMMON_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'at', 'be', 'do', 'for', 'how', 'in', 'is', 'it', 'like',
+    'me', 'my', 'now', 'of', 'on', 'or', 'so', 'the', 'to', 'today', 'tomorrow',
+    'what', "what's", 'when', 'where', 'why', 'will', 'with', 'you'
+])
+
+
+def normalize_name(text: str) -> str:
+    return " ".join(_TOKEN_RE.findall(text.lower()))
+
+
+class CityGazetteer:
+    """
+    Local lookup of known city names so location extraction can skip Claude.
+    Names are loaded from a GeoNames dump (e.g. cities1000.txt) into a
+    marisa-trie, or a frozenset when marisa-trie is not installed.
+    """
+
+    def __init__(self, path: Optional[str] = None, ignore_words: Iterable[str] = ()):
+        self.path = path or os.getenv("CITY_GAZETTEER_PATH")
+        self.ignore_words = _COMMON_WORDS | frozenset(ignore_words)
+        self._names = frozenset()
+
+        if not self.path:
+            return
+
+        try:
+            names = set(self._read_names(self.path))
+            self._names = marisa_trie.Trie(names) if marisa_trie is not None else frozenset(names)
+        except OSError as e:
+            print(f"City gazetteer unavailable: {str(e)}")
+
+    @staticmethod
+    def _read_names(path: str):
+        # GeoNames columns: geonameid, name, asciiname, alternatenames, ...
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                columns = line.split("\t")
+                if len(columns) < 3:
+                    continue
+                for name in (columns[1], columns[2]):
+                    normalized = normalize_name(name)
+                    if normalized:
+                        yield normalized
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def longest_match(self, q_lower: str, max_words: int = 3) -> Optional[str]:
+        """
+        Return the longest (then leftmost) 1-3 word n-gram of the query that is a known city.
+        Single words ("nice", "reading") are ordinary words too often, so they only
+        count when they follow "in", "at" or "for".
+        """
+        if not self._names:
+            return None
+
+        tokens = _TOKEN_RE.findall(q_lower)
+        for size in range(min(max_words, len(tokens)), 0, -1):
+            for start in range(len(tokens) - size + 1):
+                candidate = " ".join(tokens[start:start + size])
+                if size == 1 and (
+                    candidate in self.ignore_words
+                    or len(candidate) < 3
+                    or start == 0
+                    or tokens[start - 1] not in _LOCATION_PREPOSITIONS
+                ):
+                    continue
+                if candidate in self._names:
+                    return candidate
+        return None
+
+
+@lru_cache(maxsize=1)
+def get_gazetteer(ignore_words: frozenset = frozenset()) -> CityGazetteer:
+    """
+    Process-wide gazetteer so the city list is only loaded once
+    """
+    return CityGazetteer(ignore_words=ignore_words)
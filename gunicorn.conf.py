@@ -0,0 +1,13 @@
+# gunicorn picks this file up automatically: `gunicorn wsgi:app`
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+
+# Cooperative gevent workers: each one keeps thousands of I/O-bound requests in
+# flight, so a couple of processes are enough for this proxy workload
+worker_class = "gevent"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "2000"))
+
+# Reuse client connections between requests
+keepalive = 5
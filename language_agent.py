@@ -1,23 +1,31 @@
-from anthropic import Anthropic
 import os
-from typing import Dict
+from typing import Dict, Optional
 from datetime import datetime, timezone
 import time
-from dotenv import load_dotenv
+from anthropic_client import cached_system_prompt, get_anthropic_client
+from llm_cache import LLMCache
+from semantic_cache import get_semantic_cache
+from rate_limiter import SlidingWindowLimiter
+from request_ids import next_request_id
+
+# Exact-match cache of Claude responses keyed by (model, language, user_input)
+_RESP_CACHE = LLMCache(maxsize=1024)
+
+# Invariant system prompt prefix; the per-request language directive follows it.
+# The cache marker is currently a no-op: this prompt is far below Haiku's
+# 2048-token caching minimum, so every call is billed as uncached input
+_LANGUAGE_SYSTEM_PROMPT = "You are a helpful language assistant."
 
 class LanguageAgent:
-    def __init__(self):
-        load_dotenv(override=True)
-        self.anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
+    def __init__(self, api_key: Optional[str] = None):
+        # Environment is loaded once by the app; keys can also be injected directly
+        self.anthropic_api_key = api_key or os.getenv("ANTHROPIC_API_KEY")
         if not self.anthropic_api_key:
             raise ValueError("Missing required API key")
             
-        self.client = Anthropic(api_key=self.anthropic_api_key)
-        self.rate_limit = {
-            "limit": 100000,
-            "remaining": 100000,
-            "reset_at": int(time.time()) + 3600
-        }
+        self.client = get_anthropic_client(self.anthropic_api_key)
+        self.semantic_cache = get_semantic_cache()
+        self.rate_limiter = SlidingWindowLimiter("language", limit=100000, window=3600)
         # Define token limits
         self.MIN_INPUT_TOKENS = 1
         self.MAX_OUTPUT_TOKENS = 512
@@ -31,14 +39,6 @@ class LanguageAgent:
         estimated_tokens = self.estimate_tokens(text)
         return estimated_tokens >= self.MIN_INPUT_TOKENS and estimated_tokens <= self.MAX_TOTAL_TOKENS
 
-    def update_rate_limit(self) -> Dict:
-        self.rate_limit["remaining"] -= 1
-        if self.rate_limit["remaining"] <= 0:
-            if time.time() >= self.rate_limit["reset_at"]:
-                self.rate_limit["remaining"] = self.rate_limit["limit"]
-                self.rate_limit["reset_at"] = int(time.time()) + 3600
-        return self.rate_limit
-
     def calculate_token_usage(self, claude_response) -> Dict:
         try:
             input_tokens = claude_response.usage.input_tokens
@@ -62,6 +62,8 @@ class LanguageAgent:
 
     def process_query(self, user_input: str, language: str = "en") -> Dict:
         start_time = time.time()
+        # Capture the clock once and reuse it for every timestamp in the response
+        timestamp = datetime.fromtimestamp(start_time, timezone.utc).isoformat()
         
         try:
             # Validate input length
@@ -69,32 +71,54 @@ class LanguageAgent:
                 return {
                     "error": f"Input text must be between {self.MIN_INPUT_TOKENS} and {self.MAX_TOTAL_TOKENS} tokens",
                     "meta": {
-                        "timestamp": datetime.now(timezone.utc).isoformat()
+                        "timestamp": timestamp
                     }
                 }
 
-            # Get Claude's response with language instruction
-            message = self.client.messages.create(
-                model="claude-3-haiku-20240307",
-                max_tokens=self.MAX_OUTPUT_TOKENS,
-                system=f"You are a helpful language assistant. Respond in {language} language only.",
-                messages=[{"role": "user", "content": user_input}]
-            )
+            model = "claude-3-haiku-20240307"
+            cache_key = LLMCache.cache_key(model, lang=language, q=user_input)
+            cached = _RESP_CACHE.get(cache_key)
+            cache_status = "hit" if cached else "miss"
+
+            # Paraphrases only match within the same target language
+            namespace = f"lang:{language}"
+            if not cached:
+                cached = self.semantic_cache.lookup(namespace, user_input)
+                if cached:
+                    cache_status = "semantic_hit"
+                    _RESP_CACHE.set(cache_key, cached)
+
+            if cached:
+                response_text = cached["text"]
+                token_usage = cached["usage"]
+            else:
+                # Get Claude's response with language instruction
+                message = self.client.messages.create(
+                    model=model,
+                    max_tokens=self.MAX_OUTPUT_TOKENS,
+                    system=cached_system_prompt(_LANGUAGE_SYSTEM_PROMPT) + [
+                        {"type": "text", "text": f"Respond in {language} language only."}
+                    ],
+                    messages=[{"role": "user", "content": user_input}]
+                )
+                token_usage = self.calculate_token_usage(message)
+
+                # Extract response text
+                response_text = message.content[0].text if hasattr(message.content[0], 'text') else str(message.content)
+                _RESP_CACHE.set(cache_key, {"text": response_text, "usage": token_usage})
+                self.semantic_cache.store(namespace, user_input, {"text": response_text, "usage": token_usage})
             
             # Calculate metrics
             total_response_time = int((time.time() - start_time) * 1000)
-            token_usage = self.calculate_token_usage(message)
-            rate_limit = self.update_rate_limit()
-            
-            # Extract response text
-            response_text = message.content[0].text if hasattr(message.content[0], 'text') else str(message.content)
+            rate_limit = self.rate_limiter.hit(start_time)
             
             return {
                 "meta": {
-                    "request_id": f"req_{int(time.time())}_{hash(user_input) % 10000}",
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                    "request_id": next_request_id(start_time),
+                    "timestamp": timestamp,
                     "response_time_ms": total_response_time,
                     "version": "1.0.0",
+                    "cache": cache_status,
                     "token_limits": {
                         "min_input": self.MIN_INPUT_TOKENS,
                         "max_output": self.MAX_OUTPUT_TOKENS
@@ -120,6 +144,6 @@ class LanguageAgent:
             return {
                 "error": str(e),
                 "meta": {
-                    "timestamp": datetime.now(timezone.utc).isoformat()
+                    "timestamp": timestamp
                 }
             }
@@ -0,0 +1,45 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import hashlib
+import json
+import threading
+import time
+
+
+class LLMCache:
+    """
+    Exact-match, in-process LRU cache for Claude responses, with an optional TTL in seconds
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[Optional[float], Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(model: str, **parts) -> str:
+        payload = json.dumps({"m": model, **parts}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at is not None and time.time() >= expires_at:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Dict) -> None:
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
@@ -0,0 +1,96 @@
+from typing import Dict, Optional
+import math
+import os
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Count the hit and read the previous window in one atomic step
+_SLIDING_WINDOW_LUA = """
+local current = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+return {current, previous}
+"""
+
+# After a Redis failure, count locally for this long instead of paying a timeout per request
+_REDIS_COOLDOWN = 30
+
+
+class SlidingWindowLimiter:
+    """
+    Sliding-window request counter shared across workers through Redis.
+    The previous fixed window is weighted by how much of it still overlaps
+    the sliding window. Without Redis (or for a cooldown after it fails)
+    counts are kept per process instead.
+    """
+
+    def __init__(self, name: str, limit: int = 100000, window: int = 3600, redis_url: Optional[str] = None):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self._redis = None
+        self._script = None
+        self._redis_retry_at = 0.0
+        self._local_counts: Dict[int, int] = {}
+        self._local_lock = threading.Lock()
+
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if redis is not None and redis_url:
+            try:
+                # Short timeouts so a stalled Redis falls back to local counts quickly
+                self._redis = redis.Redis.from_url(redis_url, socket_connect_timeout=0.2, socket_timeout=0.2)
+                self._script = self._redis.register_script(_SLIDING_WINDOW_LUA)
+            except Exception as e:
+                print(f"Rate limiter using local counts: {str(e)}")
+                self._redis = None
+
+    def _count_redis(self, bucket: int):
+        keys = [f"rl:{self.name}:{bucket}", f"rl:{self.name}:{bucket - 1}"]
+        current, previous = self._script(keys=keys, args=[self.window * 2])
+        return int(current), int(previous)
+
+    def _count_local(self, bucket: int):
+        with self._local_lock:
+            # Only roll the window forward; a slow request reporting an older bucket
+            # must not drop the newer bucket's count
+            if bucket > max(self._local_counts, default=bucket - 1):
+                self._local_counts = {
+                    bucket - 1: self._local_counts.get(bucket - 1, 0),
+                    bucket: 0
+                }
+            current = self._local_counts.get(bucket, 0) + 1
+            self._local_counts[bucket] = current
+            previous = self._local_counts.get(bucket - 1, 0)
+        return current, previous
+
+    def hit(self, now: Optional[float] = None) -> Dict:
+        """
+        Record one request and return the limit, remaining requests and reset time
+        """
+        now = time.time() if now is None else now
+        bucket = int(now // self.window)
+
+        counts = None
+        if self._redis is not None and time.monotonic() >= self._redis_retry_at:
+            try:
+                counts = self._count_redis(bucket)
+            except Exception as e:
+                print(f"Rate limiter Redis error, using local counts for {_REDIS_COOLDOWN}s: {str(e)}")
+                self._redis_retry_at = time.monotonic() + _REDIS_COOLDOWN
+        if counts is None:
+            counts = self._count_local(bucket)
+
+        current, previous = counts
+        overlap = 1 - (now - bucket * self.window) / self.window
+        used = math.ceil(previous * overlap + current)
+
+        return {
+            "limit": self.limit,
+            "remaining": max(0, self.limit - used),
+            "reset_at": (bucket + 1) * self.window
+        }
@@ -0,0 +1,13 @@
+import itertools
+import os
+
+# One sequence for every agent in the process, so ids never repeat within a worker
+_REQ_SEQ = itertools.count()
+
+
+def next_request_id(ts: float) -> str:
+    """
+    Request id unique across agents and workers: timestamp, worker pid, then sequence.
+    The pid is read per call so forked workers never share a prefix.
+    """
+    return f"req_{int(ts)}_{os.getpid():x}_{next(_REQ_SEQ):08x}"
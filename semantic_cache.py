@@ -0,0 +1,179 @@
+from functools import lru_cache
+from typing import Dict, Optional
+import hashlib
+import json
+import os
+import re
+import time
+
+# numpy, redis and sentence-transformers (which pulls in torch) are imported only
+# once the cache is enabled, so workers without it skip their load time and memory
+np = None
+redis = None
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+
+# After a Redis failure, skip the cache for this long instead of paying a timeout per request
+_REDIS_COOLDOWN = 30
+
+
+def _gevent_patched() -> bool:
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+class SemanticCache:
+    """
+    Redis vector cache that serves stored Claude replies for paraphrased queries.
+    Entries only match within the same namespace, so e.g. different target
+    languages never share answers. Any Redis failure falls through to a miss,
+    and the cache is skipped for a short cooldown afterwards.
+    Off unless SEMANTIC_CACHE_ENABLED is set: near-identical prompts with
+    different answers ("2+2" vs "2+3") can fall inside the threshold.
+    """
+    INDEX_NAME = "idx:claude_semantic"
+    KEY_PREFIX = "semcache:"
+
+    def __init__(self, redis_url: Optional[str] = None, enabled: Optional[bool] = None,
+                 distance_threshold: float = 0.15, ttl: int = 3600):
+        if enabled is None:
+            enabled = os.getenv("SEMANTIC_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+        self.redis_url = redis_url or os.getenv("REDIS_URL")
+        self.distance_threshold = distance_threshold
+        self.ttl = ttl
+        self._redis = None
+        self._model = None
+        self._redis_retry_at = 0.0
+
+        if not enabled or not self.redis_url:
+            return
+
+        global np, redis
+        try:
+            import numpy as np
+            import redis
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            print(f"Semantic cache disabled: {str(e)}")
+            return
+
+        try:
+            # Short timeouts so a stalled Redis falls through to Claude quickly
+            self._redis = redis.Redis.from_url(self.redis_url, socket_connect_timeout=0.2, socket_timeout=0.2)
+            self._model = SentenceTransformer(EMBEDDING_MODEL, backend="onnx")
+            self._ensure_index()
+        except Exception as e:
+            print(f"Semantic cache disabled: {str(e)}")
+            self._redis = None
+
+        # Lookup and store embed the same text back-to-back on a miss
+        self.embed = lru_cache(maxsize=256)(self.embed)
+
+    @property
+    def enabled(self) -> bool:
+        return self._redis is not None
+
+    def _available(self) -> bool:
+        return self.enabled and time.monotonic() >= self._redis_retry_at
+
+    def _redis_failed(self, action: str, e: Exception) -> None:
+        print(f"Semantic cache {action} error, skipping cache for {_REDIS_COOLDOWN}s: {str(e)}")
+        self._redis_retry_at = time.monotonic() + _REDIS_COOLDOWN
+
+    def _ensure_index(self):
+        try:
+            self._redis.ft(self.INDEX_NAME).info()
+        except redis.ResponseError:
+            from redis.commands.search.field import TagField, VectorField
+            try:
+                from redis.commands.search.index_definition import IndexDefinition, IndexType
+            except ImportError:  # redis-py < 6
+                from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+
+            schema = (
+                TagField("namespace"),
+                VectorField("vec", "HNSW", {
+                    "TYPE": "FLOAT32",
+                    "DIM": EMBEDDING_DIM,
+                    "DISTANCE_METRIC": "COSINE"
+                })
+            )
+            try:
+                self._redis.ft(self.INDEX_NAME).create_index(
+                    schema,
+                    definition=IndexDefinition(prefix=[self.KEY_PREFIX], index_type=IndexType.HASH)
+                )
+            except redis.ResponseError as e:
+                # Another worker created it between our FT.INFO and FT.CREATE
+                if "already exists" not in str(e).lower():
+                    raise
+
+    def embed(self, text: str) -> bytes:
+        # encode() is CPU-bound (a few ms per query); under gevent workers run it on
+        # the hub's native threadpool so it doesn't stall every other greenlet
+        if _gevent_patched():
+            import gevent
+            vector = gevent.get_hub().threadpool.apply(
+                self._model.encode, (text,), {"normalize_embeddings": True}
+            )
+        else:
+            vector = self._model.encode(text, normalize_embeddings=True)
+        return np.asarray(vector, dtype=np.float32).tobytes()
+
+    def lookup(self, namespace: str, text: str) -> Optional[Dict]:
+        """
+        Return the cached payload of the nearest stored query within the distance threshold
+        """
+        if not self._available():
+            return None
+
+        from redis.commands.search.query import Query
+
+        try:
+            tag = re.sub(r"(\W)", r"\\\1", namespace)
+            query = (
+                Query(f"@namespace:{{{tag}}} @vec:[VECTOR_RANGE $radius $vec]=>{{$YIELD_DISTANCE_AS: distance}}")
+                .sort_by("distance")
+                .paging(0, 1)
+                .return_fields("payload", "distance")
+                .dialect(2)
+            )
+            result = self._redis.ft(self.INDEX_NAME).search(
+                query,
+                query_params={"radius": self.distance_threshold, "vec": self.embed(text)}
+            )
+            if not result.docs:
+                return None
+            return json.loads(result.docs[0].payload)
+        except Exception as e:
+            self._redis_failed("lookup", e)
+            return None
+
+    def store(self, namespace: str, text: str, payload: Dict, ttl: Optional[int] = None) -> None:
+        if not self._available():
+            return
+
+        try:
+            key = f"{self.KEY_PREFIX}{namespace}:{hashlib.sha256(text.encode()).hexdigest()}"
+            pipe = self._redis.pipeline()
+            pipe.hset(key, mapping={
+                "namespace": namespace,
+                "payload": json.dumps(payload),
+                "vec": self.embed(text)
+            })
+            pipe.expire(key, ttl or self.ttl)
+            pipe.execute()
+        except Exception as e:
+            self._redis_failed("store", e)
+
+
+@lru_cache(maxsize=1)
+def get_semantic_cache() -> SemanticCache:
+    """
+    Process-wide cache so both agents share one Redis client and embedding model
+    """
+    return SemanticCache()
@@ -1,118 +1,186 @@
-from anthropic import Anthropic
 import requests
-from typing import Dict, Optional, List, Tuple
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, Iterator, Optional, Tuple
 import time
 from datetime import datetime, timezone
+from collections import deque
 import re
-from dotenv import load_dotenv
+import threading
+from cachetools import TTLCache
 import os
+from anthropic_client import cached_system_prompt, get_anthropic_client, max_concurrency
+from llm_cache import LLMCache
+from semantic_cache import get_semantic_cache
+from rate_limiter import SlidingWindowLimiter
+from request_ids import next_request_id
+from gazetteer import get_gazetteer
 
-class WeatherAgent:
+# Exact-match cache of off-topic replies; those prompts repeat heavily, and a
+# short TTL keeps some of the temperature=0.7 variety
+_RESP_CACHE = LLMCache(maxsize=1024, ttl=60)
+
+# Static persona prompts, marked for Anthropic prompt caching. The markers are
+# currently a no-op: both prompts are far below Haiku's 2048-token caching minimum
+_WEATHER_CHAT_PROMPT = """You are a witty weather agent with a great sense of humor. 
+        Generate a funny response to the user's weather-related chat that incorporates 
+        both the location and current weather conditions. Keep it light and playful, 
+        but informative. Use weather puns and jokes when appropriate. Keep the response concise."""
+
+_NON_WEATHER_PROMPT = """You are a weather agent. When users ask non-weather questions:
+        - Respond with EXACTLY ONE short sentence
+        - Include a weather-related pun or metaphor
+        - Politely redirect to weather topics
+        - Keep it under 15 words"""
+
+# Location patterns that exclude time references
+_LOC_PATTERNS = tuple(re.compile(p) for p in [
+    r"weather (?:in|at|for) ([\w\s]+?)(?:\s+(?:today|now|tomorrow))?\??$",
+    r"weather ([\w\s]+?)(?:\s+(?:today|now|tomorrow))?\??$",
+    r"(?:what's|what is|how's|how is) (?:the )?weather (?:like )?(?:in|at|for) ([\w\s]+?)(?:\s+(?:today|now|tomorrow))?\??$",
+    r"temperature (?:in|at|for) ([\w\s]+?)(?:\s+(?:today|now|tomorrow))?\??$"
+])
+_TRAIL_TIME = re.compile(r'\s*(?:today|now|tomorrow)\s*$')
+
+_WEATHER_KEYWORDS = frozenset([
+    'weather', 'temperature', 'rain', 'snow', 'wind', 'sunny', 'cloudy',
+    'forecast', 'humidity', 'storm', 'climate', 'precipitation', 'cold',
+    'hot', 'warm', 'chilly', 'freezing', 'degrees', 'celsius', 'fahrenheit'
+])
+
+# All weather-query patterns as one alternation, so classification is a single scan
+_WEATHER_QUERY_PATTERNS = [
+    r'weather (?:in|at|for)',
+    r'(?:what\'s|what is|how\'s|how is) (?:the )?weather',
+    r'temperature (?:in|at|for)',
+    r'is it (?:raining|snowing|sunny|cloudy)',
+    r'will it (?:rain|snow)',
+    r'forecast'
+]
+_IS_WEATHER_RE = re.compile('|'.join(f'(?:{p})' for p in _WEATHER_QUERY_PATTERNS))
+
+class _InflightLookup:
+    """
+    Upstream weather lookup shared by concurrent callers asking for the same city
+    """
     def __init__(self):
-        # Make sure to load the environment variables
-        load_dotenv(override=True)
-        self.anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
-        self.weather_api_key = os.getenv("WEATHER_API_KEY")
-        self.rate_limit = {
-            "limit": 100000,
-            "remaining": 100000,
-            "reset_at": int(time.time()) + 3600
-        }
+        self.done = threading.Event()
+        self.result: Tuple[Optional[Dict], int, bool] = (None, 0, True)
+
+class WeatherAgent:
+    # Single-sentence fallbacks for off-topic queries
+    _FALLBACKS = (
+        "Let's forecast a change of topic to the weather instead! ☔",
+        "My expertise is as focused as a laser through a rain cloud - weather only! 🌧",
+        "Like a weather vane, I only point towards meteorological matters! 🌤",
+        "My forecast shows a 100% chance of weather-related conversations ahead! 🌈"
+    )
+    # Skip Claude for off-topic replies after this many errors within the window
+    _BREAKER_MAX_ERRORS = 3
+    _BREAKER_WINDOW = 60
+
+    def __init__(self, anthropic_api_key: Optional[str] = None, weather_api_key: Optional[str] = None):
+        # Environment is loaded once by the app; keys can also be injected directly
+        self.anthropic_api_key = anthropic_api_key or os.getenv("ANTHROPIC_API_KEY")
+        self.weather_api_key = weather_api_key or os.getenv("WEATHER_API_KEY")
+        self.rate_limiter = SlidingWindowLimiter("weather", limit=100000, window=3600)
         
         if not self.weather_api_key or not self.anthropic_api_key:
             raise ValueError("Missing required API keys")
             
-        self.client = Anthropic(api_key=self.anthropic_api_key)
+        self.client = get_anthropic_client(self.anthropic_api_key)
+        self.semantic_cache = get_semantic_cache()
+        self.gazetteer = get_gazetteer(_WEATHER_KEYWORDS)
         self.last_location = None  # Store the last queried location
+        self._anthropic_errors = deque()  # Timestamps of recent off-topic Claude failures
+        # OpenWeather updates current conditions about every 10 minutes, so successful
+        # lookups are reused for 5 minutes
+        self._weather_cache = TTLCache(maxsize=5000, ttl=300)
+        self._inflight: Dict[str, _InflightLookup] = {}
+        self._inflight_lock = threading.RLock()
+
+        # Pooled keep-alive session so OpenWeather connections are reused across requests;
+        # sized like the Claude pool so concurrent greenlets don't churn connections
+        self._http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=max_concurrency(),
+            # Retry only the listed gateway statuses, never connect/read timeouts, and hand
+            # back the last response once retries run out so its status still gets logged
+            max_retries=Retry(
+                total=2,
+                connect=0,
+                read=0,
+                backoff_factor=0.1,
+                status_forcelist=[502, 503, 504],
+                raise_on_status=False
+            )
+        )
+        self._http.mount("http://", adapter)
+        self._http.mount("https://", adapter)
 
 
 
-    def extract_location(self, query: str) -> Optional[Dict[str, str]]:
+    def extract_location(self, q_lower: str) -> Optional[Dict[str, str]]:
         """
-        Extract location from query with improved handling of time references
+        Extract location from a lowercased, stripped query with improved handling of time references
         """
-        # Clean the query first
-        query = query.lower().strip()
-        
-        # Updated patterns that exclude time references
-        patterns = [
-            r"weather (?:in|at|for) ([\w\s]+?)(?:\s+(?:today|now|tomorrow))?\??$",
-            r"weather ([\w\s]+?)(?:\s+(?:today|now|tomorrow))?\??$",
-            r"(?:what's|what is|how's|how is) (?:the )?weather (?:like )?(?:in|at|for) ([\w\s]+?)(?:\s+(?:today|now|tomorrow))?\??$",
-            r"temperature (?:in|at|for) ([\w\s]+?)(?:\s+(?:today|now|tomorrow))?\??$"
-        ]
-        
         # Try each pattern
-        for pattern in patterns:
-            match = re.search(pattern, query)
+        for pattern in _LOC_PATTERNS:
+            match = pattern.search(q_lower)
             if match:
                 location = match.group(1).strip()
                 # Remove any trailing time references if they somehow got included
-                location = re.sub(r'\s*(?:today|now|tomorrow)\s*$', '', location)
+                location = _TRAIL_TIME.sub('', location)
                 return {"city": location}
 
-        # If no pattern matches, try Claude as fallback
+        # Then look for a known city name locally
+        location = self.gazetteer.longest_match(q_lower)
+        if location:
+            return {"city": location}
+
+        # If nothing matches, try Claude as fallback
         try:
             message = self.client.messages.create(
                 model="claude-3-haiku-20240307",
                 max_tokens=70,
                 system="Extract only the city name from the weather query. Remove any time references. Respond with just the city name, nothing else.",
-                messages=[{"role": "user", "content": query}]
+                messages=[{"role": "user", "content": q_lower}]
             )
             location = message.content[0].text.strip()
             # Clean up the extracted location
-            location = re.sub(r'\s*(?:today|now|tomorrow)\s*$', '', location)
+            location = _TRAIL_TIME.sub('', location)
             return {"city": location} if location else None
         except Exception as e:
             print(f"Claude API Error in location extraction: {str(e)}")
             return None
 
-    def is_weather_related(self, query: str) -> bool:
+    def is_weather_related(self, q_words: frozenset) -> bool:
         """
-        Check if the query is weather-related
+        Check if the query's lowercased words are weather-related
         """
-        weather_keywords = [
-            'weather', 'temperature', 'rain', 'snow', 'wind', 'sunny', 'cloudy',
-            'forecast', 'humidity', 'storm', 'climate', 'precipitation', 'cold',
-            'hot', 'warm', 'chilly', 'freezing', 'degrees', 'celsius', 'fahrenheit'
-        ]
-        query_words = query.lower().split()
-        return any(keyword in query_words for keyword in weather_keywords)
-
-    def is_weather_query(self, query: str) -> bool:
+        return not _WEATHER_KEYWORDS.isdisjoint(q_words)
+
+    def is_weather_query(self, q_lower: str) -> bool:
         """
-        Check if the query is asking for weather information
+        Check if the lowercased query is asking for weather information
         """
-        weather_patterns = [
-            r'weather (?:in|at|for)',
-            r'(?:what\'s|what is|how\'s|how is) (?:the )?weather',
-            r'temperature (?:in|at|for)',
-            r'is it (?:raining|snowing|sunny|cloudy)',
-            r'will it (?:rain|snow)',
-            r'forecast'
-        ]
-        return any(re.search(pattern, query.lower()) for pattern in weather_patterns)
+        return _IS_WEATHER_RE.search(q_lower) is not None
 
     def generate_weather_chat_response(self, query: str, weather_data: Dict) -> str:
         """
         Generate a humorous weather-related chat response with location context
         """
-        system_prompt = """You are a witty weather agent with a great sense of humor. 
-        Generate a funny response to the user's weather-related chat that incorporates 
-        both the location and current weather conditions. Keep it light and playful, 
-        but informative. Use weather puns and jokes when appropriate. Keep the response concise."""
-
         location_name = weather_data.get("location", {}).get("city", "your area")
         
         try:
             message = self.client.messages.create(
                 model="claude-3-haiku-20240307",
                 max_tokens=200,
-                system=system_prompt,
+                system=cached_system_prompt(_WEATHER_CHAT_PROMPT),
                 messages=[{
                     "role": "user",
-                    "content": f"Location: {location_name}\nCurrent weather: {json.dumps(weather_data)}\nUser chat: {query}"
+                    "content": f"Location: {location_name}\nCurrent weather: {self.summarize_weather(weather_data)}\nUser chat: {query}"
                 }]
             )
             return message.content[0].text if hasattr(message.content[0], 'text') else str(message.content)
@@ -123,46 +191,95 @@ class WeatherAgent:
         """
         Generate a concise, single-sentence response for non-weather queries
         """
-        system_prompt = """You are a weather agent. When users ask non-weather questions:
-        - Respond with EXACTLY ONE short sentence
-        - Include a weather-related pun or metaphor
-        - Politely redirect to weather topics
-        - Keep it under 15 words"""
+        model = "claude-3-haiku-20240307"  # Using Haiku for efficiency
+        cache_key = LLMCache.cache_key(model, kind="non_weather", q=query)
+        cached = _RESP_CACHE.get(cache_key)
+        if not cached:
+            cached = self.semantic_cache.lookup("weather_chat", query)
+            if cached:
+                _RESP_CACHE.set(cache_key, cached)
+        if cached:
+            return cached["text"]
+
+        # Circuit breaker: while Claude keeps failing, answer from the fallbacks directly
+        now = time.time()
+        while self._anthropic_errors and now - self._anthropic_errors[0] > self._BREAKER_WINDOW:
+            self._anthropic_errors.popleft()
+        if len(self._anthropic_errors) > self._BREAKER_MAX_ERRORS:
+            return self._FALLBACKS[hash(query) % len(self._FALLBACKS)]
 
         try:
             message = self.client.messages.create(
-                model="claude-3-haiku-20240307",  # Using Haiku for efficiency
+                model=model,
                 max_tokens=50,  # Limiting token count
                 temperature=0.7,  # Add some variety to responses
-                system=system_prompt,
+                system=cached_system_prompt(_NON_WEATHER_PROMPT),
                 messages=[{
                     "role": "user",
                     "content": f"Off-topic question: {query}"
                 }]
             )
-            return message.content[0].text if hasattr(message.content[0], 'text') else str(message.content)
+            response_text = message.content[0].text if hasattr(message.content[0], 'text') else str(message.content)
+            _RESP_CACHE.set(cache_key, {"text": response_text})
+            # Same short TTL as the exact-match cache, or the Redis entry would freeze the reply
+            self.semantic_cache.store("weather_chat", query, {"text": response_text}, ttl=_RESP_CACHE.ttl)
+            return response_text
         except Exception as e:
-            # Single-sentence fallbacks
-            responses = [
-                "Let's forecast a change of topic to the weather instead! ☔",
-                "My expertise is as focused as a laser through a rain cloud - weather only! 🌧",
-                "Like a weather vane, I only point towards meteorological matters! 🌤",
-                "My forecast shows a 100% chance of weather-related conversations ahead! 🌈"
-            ]
-            return responses[int(time.time()) % len(responses)]
+            self._anthropic_errors.append(time.time())
+            return self._FALLBACKS[hash(query) % len(self._FALLBACKS)]
 
     def estimate_tokens(self, text: str) -> int:
         return len(text.split())
 
     def get_weather_data(self, location: Dict[str, str]) -> Tuple[Optional[Dict], int, bool]:
         """
-        Get weather data with improved error handling
+        Get weather data, coalescing concurrent lookups for the same city into one upstream call
         """
+        city = (location.get("city") or "").strip()
+        if not city:
+            return None, 0, True
+
+        key = city.lower()
+        with self._inflight_lock:
+            cached = self._weather_cache.get(key)
+            if cached is not None:
+                return cached, 0, False
+            lookup = self._inflight.get(key)
+            is_leader = lookup is None
+            if is_leader:
+                lookup = self._inflight[key] = _InflightLookup()
+
+        if not is_leader:
+            lookup.done.wait()
+            return lookup.result
+
         try:
-            city = location.get("city", "").strip()
-            if not city:
-                return None, 0, True
+            lookup.result = self.fetch_weather_data(city)
+        finally:
+            with self._inflight_lock:
+                data, _, fallback_used = lookup.result
+                if data is not None and not fallback_used:
+                    self._weather_cache[key] = data
+                del self._inflight[key]
+            lookup.done.set()
+        return lookup.result
 
+    def invalidate_weather_cache(self, city: Optional[str] = None) -> int:
+        """
+        Drop this process's cached weather for one city, or for every city when none is given
+        """
+        with self._inflight_lock:
+            if city is None:
+                removed = len(self._weather_cache)
+                self._weather_cache.clear()
+                return removed
+            return 1 if self._weather_cache.pop(city.lower().strip(), None) is not None else 0
+
+    def fetch_weather_data(self, city: str) -> Tuple[Optional[Dict], int, bool]:
+        """
+        Fetch current weather for a city from OpenWeather with improved error handling
+        """
+        try:
             url = "http://api.openweathermap.org/data/2.5/weather"
             params = {
                 "q": city,  # Use cleaned city name
@@ -171,7 +288,8 @@ class WeatherAgent:
             }
             
             start_time = time.time()
-            response = requests.get(url, params=params, timeout=10)
+            # Fail fast on connect, allow a little longer for the read
+            response = self._http.get(url, params=params, timeout=(2, 5))
             api_response_time = int((time.time() - start_time) * 1000)
             
             if response.status_code == 200:
@@ -181,7 +299,7 @@ class WeatherAgent:
             return None, api_response_time, True
             
         except Exception as e:
-            print(f"Error in get_weather_data: {str(e)}")
+            print(f"Error in fetch_weather_data: {str(e)}")
             return None, 0, True
 
     def format_weather_data(self, data: Dict) -> Dict:
@@ -233,32 +351,30 @@ class WeatherAgent:
             print(f"Data formatting error: {str(e)}")
             return {"error": "Error formatting weather data"}
 
-    def update_rate_limit(self) -> Dict:
-        self.rate_limit["remaining"] -= 1
-        if self.rate_limit["remaining"] <= 0:
-            if time.time() >= self.rate_limit["reset_at"]:
-                self.rate_limit["remaining"] = self.rate_limit["limit"]
-                self.rate_limit["reset_at"] = int(time.time()) + 3600
-        return self.rate_limit
+    def summarize_weather(self, formatted_weather: Dict) -> str:
+        """
+        Compact one-line summary of formatted weather data for Claude prompts
+        """
+        if not formatted_weather or "error" in formatted_weather:
+            return "Weather data currently unavailable"
+
+        location = formatted_weather["location"]
+        place = ", ".join(part for part in (location.get("city"), location.get("country")) if part) or "unknown location"
+        temperature = formatted_weather["temperature"]
+        return (
+            f"In {place}: {temperature['celsius']}°C ({temperature['fahrenheit']}°F), "
+            f"feels like {temperature['feels_like_c']}°C, {formatted_weather['conditions']['description']}, "
+            f"wind {formatted_weather['wind']['speed_ms']}m/s, humidity {formatted_weather['humidity']}%"
+        )
 
     def calculate_confidence_score(self, weather_data: Dict, claude_response, response_time: int) -> float:
-        score = 1.0
-        factors: List[float] = []
-        
-        if weather_data and "dt" in weather_data:
-            data_age = time.time() - weather_data["dt"]
-            freshness_score = max(0, 1 - (data_age / 3600))
-            factors.append(freshness_score * 0.4)
-        
-        required_fields = ['main', 'weather', 'wind']
+        # Weighted: data freshness 0.4, field completeness 0.4, response time 0.2
+        score = 0.2 * max(0.0, 1 - response_time / 2000)
         if weather_data:
-            completeness = sum(1 for field in required_fields if field in weather_data) / len(required_fields)
-            factors.append(completeness * 0.4)
-        
-        response_time_score = max(0, 1 - (response_time / 2000))
-        factors.append(response_time_score * 0.2)
-        
-        return round(sum(factors), 2) if factors else 0.5
+            if "dt" in weather_data:
+                score += 0.4 * max(0.0, 1 - (time.time() - weather_data["dt"]) / 3600)
+            score += 0.4 * (("main" in weather_data) + ("weather" in weather_data) + ("wind" in weather_data)) / 3
+        return round(score, 2)
 
     def calculate_token_usage(self, claude_response) -> Dict:
         try:
@@ -279,19 +395,37 @@ class WeatherAgent:
             }
 
     def process_query(self, query: str) -> Dict:
+        """
+        Run a query to completion and return the full response
+        """
+        for event, payload in self.stream_query(query):
+            if event == "done":
+                return payload
+
+    def stream_query(self, query: str) -> Iterator[Tuple[str, Dict]]:
+        """
+        Process a query, yielding ("delta", {"delta": text}) events while a weather
+        report is generated and finally ("done", response) with the full response
+        """
         start_time = time.time()
+        # Capture the clock once and reuse it for every timestamp in the response
+        timestamp = datetime.fromtimestamp(start_time, timezone.utc).isoformat()
+        
+        # Normalize once and share across the classifiers and location extraction
+        q_lower = query.lower().strip()
+        q_words = frozenset(q_lower.split())
         
         # Check if it's a weather query or weather-related chat
-        is_direct_weather_query = self.is_weather_query(query)
-        is_weather_chat = self.is_weather_related(query)
+        is_direct_weather_query = self.is_weather_query(q_lower)
+        is_weather_chat = self.is_weather_related(q_words)
         
         # Handle non-weather queries first
         if not (is_direct_weather_query or is_weather_chat):
-            rate_limit = self.update_rate_limit()
-            return {
+            rate_limit = self.rate_limiter.hit(start_time)
+            yield "done", {
                 "meta": {
-                    "request_id": f"req_{int(time.time())}_{hash(query) % 10000}",
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                    "request_id": next_request_id(start_time),
+                    "timestamp": timestamp,
                     "response_time_ms": int((time.time() - start_time) * 1000),
                     "api_response_time_ms": 0,
                     "version": "1.0.0"
@@ -321,9 +455,10 @@ class WeatherAgent:
                     "extracted_location": None
                 }
             }
+            return
         
         # Get location - either from query or use last known location
-        location = self.extract_location(query)
+        location = self.extract_location(q_lower)
         
         # Use last known location for weather-related chat if no location found
         if not location and self.last_location and is_weather_chat and not is_direct_weather_query:
@@ -333,7 +468,8 @@ class WeatherAgent:
             # Cache new location when found
             self.last_location = location
         elif not location and is_direct_weather_query:
-            return {"error": "Could not determine location from query"}
+            yield "done", {"error": "Could not determine location from query"}
+            return
         elif not location:
             # If no location found and no cache for chat
             location = {"city": "general"}  # Default for general weather chat
@@ -356,12 +492,12 @@ class WeatherAgent:
             
             total_response_time = int((time.time() - start_time) * 1000)
             token_usage = self.calculate_token_usage(message)
-            rate_limit = self.update_rate_limit()
+            rate_limit = self.rate_limiter.hit(start_time)
             
-            return {
+            yield "done", {
                 "meta": {
-                    "request_id": f"req_{int(time.time())}_{hash(query) % 10000}",
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                    "request_id": next_request_id(start_time),
+                    "timestamp": timestamp,
                     "response_time_ms": total_response_time,
                     "api_response_time_ms": api_response_time,
                     "version": "1.0.0"
@@ -383,30 +519,34 @@ class WeatherAgent:
                     "extracted_location": location
                 }
             }
+            return
         
-        # For direct weather queries, continue with normal weather report
-        message = self.client.messages.create(
+        # For direct weather queries, stream the normal weather report
+        with self.client.messages.stream(
             model="claude-3-haiku-20240307",
             max_tokens=400,
             system=f"You are a helpful and friendly weather assistant. Provide your response as plain text.",
             messages=[{
                 "role": "user",
-                "content": f"Current weather data: {json.dumps(formatted_weather)} User query: {query}"
+                "content": f"Current weather: {self.summarize_weather(formatted_weather)}\nUser query: {query}"
             }]
-        )
+        ) as stream:
+            for text in stream.text_stream:
+                yield "delta", {"delta": text}
+            message = stream.get_final_message()
         
         total_response_time = int((time.time() - start_time) * 1000)
-        data_freshness = int(time.time() - weather_data["dt"]) if weather_data and "dt" in weather_data else None
+        data_freshness = int(start_time - weather_data["dt"]) if weather_data and "dt" in weather_data else None
         confidence_score = self.calculate_confidence_score(weather_data, message, total_response_time)
         token_usage = self.calculate_token_usage(message)
-        rate_limit = self.update_rate_limit()
+        rate_limit = self.rate_limiter.hit(start_time)
         
         response_text = message.content[0].text if hasattr(message.content[0], 'text') else str(message.content)
         
-        return {
+        yield "done", {
             "meta": {
-                "request_id": f"req_{int(time.time())}_{hash(query) % 10000}",
-                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "request_id": next_request_id(start_time),
+                "timestamp": timestamp,
                 "response_time_ms": total_response_time,
                 "api_response_time_ms": api_response_time,
                 "version": "1.0.0"
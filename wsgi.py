@@ -0,0 +1,8 @@
+# Patch the stdlib before flask, requests or anthropic import socket/ssl,
+# so blocking OpenWeather and Claude calls yield to the gevent loop.
+from gevent import monkey
+monkey.patch_all()
+
+from combined_agent import app  # noqa: E402
+
+# gunicorn wsgi:app  (settings in gunicorn.conf.py)